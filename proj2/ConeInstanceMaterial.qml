@@ -0,0 +1,34 @@
+import Qt3D.Core 2.0
+import Qt3D.Render 2.0
+
+// material for instanced cones, each instance has its own transform and color
+
+Material {
+    effect: Effect {
+        techniques: [
+            Technique {
+                filterKeys: [
+                    FilterKey {
+                        id: forward
+                        name: "renderingStyle"
+                        value: "forward"
+                    }
+                ]
+                // only works in OpenGL 3.3, the shaders need GLSL 3.30
+                graphicsApiFilter {
+                    api: GraphicsApiFilter.OpenGL
+                    profile: GraphicsApiFilter.CoreProfile
+                    majorVersion: 3
+                    minorVersion: 3
+                }
+                renderPasses: RenderPass {
+                    shaderProgram: ShaderProgram {
+                        // use custom shaders
+                        vertexShaderCode: loadSource("file:proj2/cone_instance.vert")
+                        fragmentShaderCode: loadSource("file:proj2/cone_instance.frag")
+                    }
+                }
+            }
+        ]
+    }
+}
@@ -4,12 +4,14 @@ import sys
 import math
 import itertools
 
+import numpy as np
 from PyQt5.QtGui import QVector3D
 from PyQt5.QtWidgets import QApplication
 
 from .animation import Animation
 from .rig import Rig, Joint
 from . import util
+from . import _kin
 
 
 class Proj2Ani(Animation):
@@ -17,7 +19,14 @@ class Proj2Ani(Animation):
     Implements the kinematics animation.
     """
 
-    def __init__(self):
+    def __init__(self, instanced_joints=False):
+        """
+        Creates the animation.
+
+        Arguments:
+            instanced_joints: bool, whether to draw the rig's joints in one instanced draw call, which needs OpenGL 3.3
+        """
+        self.instanced_joints = instanced_joints
         super().__init__(
             title='CS 4732 Project 2 by Daniel Beckwith',
             frame_rate=60.0,
@@ -49,31 +58,50 @@ class Proj2Ani(Animation):
         self.wing_len = 5 # number of wing joints
         self.wing_joint_len = 0.15 # length of each wing joint
 
+        self.spine_wave_magnitude = 0.5 # magnitude of the spine's sine wave
+        self.spine_wave_table = _kin.wave_table(self.spine_wave_magnitude, 1024) # lookup table for the spine's wave rotations
+        self.wing_wave_magnitude = 0.4 # magnitude of the wings' sine wave
+        self.wing_wave_table = _kin.wave_table(self.wing_wave_magnitude, 1024) # lookup table for the wings' wave rotations
+
         # initialize rig with root joint (which is part of the spine)
         self.rig = Rig(Joint(self,
             length=self.spine_joint_len,
             thickness=0.06,
-            color=util.hsl(0, 100, 80))) # red color
+            color=util.hsl(0, 100, 80)), # red color
+            instanced=self.instanced_joints)
 
-        self.rig.joints.spine[0] = self.rig.joints.root # include root in list of spine joints
+        spine = self.rig.joints.child('spine') # namespace holding the spine joints by index
+        spine[0] = self.rig.joints.root # include root in list of spine joints
         # create rest of spine
         for i in range(1, self.spine_len):
-            self.rig.joints.spine[i] = Joint(self,
+            spine[i] = Joint(self,
                 length=self.spine_joint_len,
                 thickness=0.04,
-                parent=self.rig.joints.spine[i - 1], # parent is previous spine joint
+                parent=spine[i - 1], # parent is previous spine joint
                 color=util.hsl(util.lerp(i, 1, self.spine_len - 1, 120, 180), 100, 80)) # fade from green to cyan
 
-        self.rig.joints.wing_root = self.rig.joints.spine[self.spine_len // 2] # pick root for wings as halfway along spine
+        self.rig.joints.wing_root = spine[self.spine_len // 2] # pick root for wings as halfway along spine
         # create both wings
+        wings = self.rig.joints.child('wings')
         for w in range(2):
+            wing = wings.child(w)
             for i in range(self.wing_len):
-                self.rig.joints.wings[w][i] = Joint(self,
+                wing[i] = Joint(self,
                     length=self.wing_joint_len,
                     thickness=0.02,
-                    parent=self.rig.joints.wing_root if i == 0 else self.rig.joints.wings[w][i - 1], # first joint's parent is the wing root, rest is previous wing joint
+                    parent=self.rig.joints.wing_root if i == 0 else wing[i - 1], # first joint's parent is the wing root, rest is previous wing joint
                     color=util.hsl(util.lerp(i, 0, self.wing_len - 1, 240, 300), 100, 80)) # fade from blue to magenta
 
+        # rotations each joint does before its wave rotation, composed with the wave rotations in update
+        # the first row is the root's, which stays pointing forward and rotates around the circular path instead, so it gets set every frame
+        self._spine_base_rotations = _kin.axis_angle_rotations([(0, -1, 0)] * self.spine_len, [self.spine_bend_angle] * self.spine_len)
+        # first wing joint rotates outwards away from body (90 degrees) plus the same small backwards bend as the rest (5 degrees)
+        wing_bend_angles = [util.deg2rad(95 if i == 0 else 5) for i in range(self.wing_len)]
+        self._wing_base_rotations = [_kin.axis_angle_rotations([(0, d, 0)] * self.wing_len, wing_bend_angles) for d in (-1, 1)]
+        # rig indices of the spine and wing joints, for writing their rotations to the rig all at once
+        self._spine_index = np.array([joint.index for joint in self.rig.joints.spine], dtype=np.int64)
+        self._wing_index = [np.array([joint.index for joint in wing], dtype=np.int64) for wing in self.rig.joints.wings]
+
         # add some lights
         self.add_light(QVector3D(-20.0, 20.0, -20.0), 1.0) # upper right key light
         self.add_light(QVector3D(20.0, 10.0, -20.0), 0.5) # upper left fill light
@@ -83,58 +111,34 @@ class Proj2Ani(Animation):
         Overriddes Animation.update
         """
         spine_wave_phase = util.lerp(t, 0, 1, 0, 2 * math.pi)
-        spine_wave_magnitude = 0.5
         wing_wave_phase = util.lerp(t + 0.5, 0, 1, 0, -2 * math.pi)
-        wing_wave_magnitude = 0.4
 
         self.rig.reset() # reset all transforms
 
         # set position and orientation of the root joint, which positions the entire rig
-        self.rig.joints.root.local_transform.translate(0, 0.7 + math.cos(util.lerp(t, 0, 10, 0, 2 * math.pi)) * spine_wave_magnitude * self.spine_joint_len, 0) # undulate up and down
-        self.rig.joints.root.local_transform.rotate(util.rad2deg(util.lerp(t, 0, 8.5, 0, 2 * math.pi)), 0, -1, 0) # rotate around circular path
-        self.rig.joints.root.local_transform.translate(self.path_radius, 0, 0) # move outward by the path's radius
-        self.rig.joints.root.local_transform.translate(0, 0, -self.spine_joint_len / 2) # small adjustment to center root joint on the circular path since the joint's origin is its base, not its center
-
-        # transform spinal joints
-        prev_global_angle = 0
-        for i, joint in enumerate(self.rig.joints.spine):
-            if i != 0:
-                # rotate each joint by the bend amount for bending along circular path
-                # except root, which should stay pointing forward
-                joint.local_transform.rotate(
-                    util.rad2deg(self.spine_bend_angle),
-                    0, -1, 0)
-
-            # rotate joints to form a sine wave
-            theta = util.lerp(i + spine_wave_phase, 0, self.spine_len, 0, 2 * math.pi)
-            # global angle is the absolute angle from the x-axis of the sine graph at this point
-            # the angle is just the inverse tangent of the derivative of the sine curve
-            global_angle = math.atan(spine_wave_magnitude * math.cos(theta))
-            # angle needed for this joint to rotate has to relative to previous joint
-            local_angle = global_angle - prev_global_angle
-            prev_global_angle = global_angle
-            joint.local_transform.rotate(
-                util.rad2deg(local_angle),
-                1, 0, 0)
-
-        # transform wing joints
-        for d, wing in zip((-1, 1), self.rig.joints.wings):
-            prev_global_angle = 0
-            for i, joint in enumerate(wing):
-                if i == 0:
-                    # rotate first wing joint outwards away from body in the wing's direction
-                    joint.local_transform.rotate(90, 0, d, 0)
-                # rotate each wing joint a little bit backwards for a nice bend
-                joint.local_transform.rotate(5, 0, d, 0)
-
-                # same sine wave idea as for the spine
-                theta = util.lerp(i + wing_wave_phase, 0, self.wing_len * 2, 0, 2 * math.pi)
-                global_angle = math.atan(wing_wave_magnitude * math.cos(theta))
-                local_angle = global_angle - prev_global_angle
-                prev_global_angle = global_angle
-                joint.local_transform.rotate(
-                    util.rad2deg(local_angle),
-                    1, 0, 0)
+        root = self.rig.joints.root
+        root_angle = util.lerp(t, 0, 8.5, 0, 2 * math.pi) # rotate around circular path
+        # root's translation is written directly in closed form instead of composing translate and rotate calls:
+        # move outward by the path's radius and then a small adjustment to center root joint on the circular path since the joint's origin is its base, not its center,
+        # both rotated around the path, and undulate up and down
+        # the root's rotation quaternion needs the cosine and sine of half the angle, so compute those once and get the full angle's from them
+        cos_half_root_angle = math.cos(root_angle / 2)
+        sin_half_root_angle = math.sin(root_angle / 2)
+        cos_root_angle = cos_half_root_angle * cos_half_root_angle - sin_half_root_angle * sin_half_root_angle
+        sin_root_angle = 2 * cos_half_root_angle * sin_half_root_angle
+        half_joint_len = self.spine_joint_len / 2
+        self.rig.local_translations[root.index] = (
+            self.path_radius * cos_root_angle + half_joint_len * sin_root_angle,
+            0.7 + math.cos(util.lerp(t, 0, 10, 0, 2 * math.pi)) * self.spine_wave_magnitude * self.spine_joint_len,
+            self.path_radius * sin_root_angle - half_joint_len * cos_root_angle)
+
+        # rotate joints to form a sine wave, writing the rotations straight into the rig
+        # root rotates around the circular path instead of bending
+        self._spine_base_rotations[0] = (cos_half_root_angle, 0, -sin_half_root_angle, 0)
+        _kin.wave_rotations(self.spine_wave_table, spine_wave_phase, self.spine_len, self._spine_base_rotations, self._spine_index, self.rig.local_rotations)
+        # same sine wave idea for the wings, both wings move the same way
+        for base_rotations, index in zip(self._wing_base_rotations, self._wing_index):
+            _kin.wave_rotations(self.wing_wave_table, wing_wave_phase, self.wing_len * 2, base_rotations, index, self.rig.local_rotations)
 
         # update all the absolute transforms from the local transforms set above
         self.rig.update()
@@ -146,11 +150,13 @@ if __name__ == '__main__':
         prog='proj2',
         description='Animates a kinematic skeleton.',
         epilog='Created by Daniel Beckwith for WPI CS 4732.')
+    parser.add_argument('--instanced-joints', action='store_true',
+        help='draw all the joints in one instanced draw call, needs OpenGL 3.3')
     args = parser.parse_args()
 
     app = QApplication([])
 
-    ani = Proj2Ani()
+    ani = Proj2Ani(instanced_joints=args.instanced_joints)
     ani.run()
 
     sys.exit(app.exec_())
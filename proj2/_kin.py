@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+
+import math
+
+import numpy as np
+from numba import njit
+
+
+def wave_table(magnitude, size):
+    """
+    Creates a lookup table of the global joint rotations along one period of a sine wave, to be sampled with sample_table.
+    The global angle is the absolute angle from the x-axis of the sine graph,
+    which is just the inverse tangent of the derivative of the sine curve.
+    The rotations are stored as the cosine and sine of half the angle, which is all a quaternion for that rotation needs.
+
+    Arguments:
+        magnitude: float, the magnitude of the wave
+        size: int, the number of entries in the table, must be a power of two
+
+    Returns:
+        a float64 array of shape (size, 2), the cosine and sine of half the global angle at size evenly spaced points in the period
+    """
+    assert size > 0 and size & (size - 1) == 0
+    half_angles = np.arctan(magnitude * np.cos(np.arange(size) * (2 * math.pi / size))) / 2
+    return np.stack((np.cos(half_angles), np.sin(half_angles)), axis=1)
+
+def axis_angle_rotations(axes, angles):
+    """
+    Creates quaternions for rotations around axes, all at once.
+
+    Arguments:
+        axes: float array of shape (n, 3), the unit axes to rotate around
+        angles: float array of length n, the angles to rotate by, in radians
+
+    Returns:
+        a float64 array of shape (n, 4), the rotations as (scalar, x, y, z) quaternions
+    """
+    half_angles = np.asarray(angles, dtype=np.float64) * 0.5
+    rotations = np.empty((half_angles.shape[0], 4))
+    # a quaternion is just the cosine and sine of the half angle, so both are computed over the whole batch in one go
+    np.cos(half_angles, out=rotations[:, 0])
+    np.multiply(axes, np.sin(half_angles)[:, np.newaxis], out=rotations[:, 1:])
+    return rotations
+
+# this and the other kernels called from python below are compiled eagerly at import with explicit signatures, so the first frame doesn't stall on compilation
+# cache=True keeps the compiled code between runs
+@njit('UniTuple(float64, 2)(float64[:, ::1], float64)', cache=True, fastmath=True)
+def sample_table(table, x):
+    """
+    Samples a periodic lookup table, linearly interpolating between entries.
+
+    Arguments:
+        table: float64 array of shape (size, 2), one period of a pair of functions, size must be a power of two
+        x: float, the position to sample at, in periods
+
+    Returns:
+        a tuple of two floats, the interpolated values of the table at x
+    """
+    x *= table.shape[0]
+    i = math.floor(x)
+    f = x - i
+    # wrap around the table, works for negative positions too
+    mask = table.shape[0] - 1
+    i0 = int(i) & mask
+    i1 = (i0 + 1) & mask
+    return (table[i0, 0] + f * (table[i1, 0] - table[i0, 0]),
+        table[i0, 1] + f * (table[i1, 1] - table[i0, 1]))
+
+@njit('void(float64[:, ::1], float64, float64, float64[:, ::1], int64[::1], float32[:, ::1])', cache=True, fastmath=True)
+def wave_rotations(table, phase, period, base_rotations, indices, rotations):
+    """
+    Computes the local rotations that bend a chain of joints into a sine wave.
+    Each joint rotates around the x-axis relative to the previous joint, after a constant base rotation.
+
+    Arguments:
+        table: float64 array, a rotation lookup table for the wave from wave_table
+        phase: float, the phase of the wave, in joints
+        period: float, the period of the wave, in joints
+        base_rotations: float array of shape (n, 4), the rotation of each joint before the wave, as a (scalar, x, y, z) quaternion
+        indices: int array of length n, the row of rotations to write each joint's rotation to
+        rotations: float array of shape (m, 4), filled with the local rotation of each joint as a (scalar, x, y, z) quaternion
+    """
+    # global rotation of the previous joint, starts out as no rotation
+    prev_c = 1.0
+    prev_s = 0.0
+    for i in range(base_rotations.shape[0]):
+        # the joint's position along the wave in periods is used to sample the table
+        c, s = sample_table(table, (i + phase) / period)
+        # rotation needed for this joint has to relative to previous joint, so the half angle is the difference of the global half angles
+        # cos(a - b) = cos(a)cos(b) + sin(a)sin(b) and sin(a - b) = sin(a)cos(b) - cos(a)sin(b), so no trig is needed
+        lc = c * prev_c + s * prev_s
+        ls = s * prev_c - c * prev_s
+        prev_c = c
+        prev_s = s
+
+        # base rotation times the wave rotation (lc, ls, 0, 0)
+        bw = base_rotations[i, 0]
+        bx = base_rotations[i, 1]
+        by = base_rotations[i, 2]
+        bz = base_rotations[i, 3]
+        j = indices[i]
+        rotations[j, 0] = bw * lc - bx * ls
+        rotations[j, 1] = bw * ls + bx * lc
+        rotations[j, 2] = by * lc + bz * ls
+        rotations[j, 3] = bz * lc - by * ls
+
+@njit(inline='always')
+def _rotate(w, x, y, z, vx, vy, vz):
+    """
+    Rotates a vector by a quaternion.
+
+    Arguments:
+        w, x, y, z: float, the rotation as a unit quaternion
+        vx, vy, vz: float, the vector to rotate
+
+    Returns:
+        a tuple of three floats, the rotated vector
+    """
+    # v + 2w(u x v) + 2u x (u x v), where u is the vector part of the quaternion
+    cx = y * vz - z * vy
+    cy = z * vx - x * vz
+    cz = x * vy - y * vx
+    return (vx + 2 * (w * cx + y * cz - z * cy),
+        vy + 2 * (w * cy + z * cx - x * cz),
+        vz + 2 * (w * cz + x * cy - y * cx))
+
+@njit(inline='always')
+def _transform_shape(w, x, y, z, tx, ty, tz, shape, out):
+    """
+    Multiplies a rigid transform by an affine shape transform.
+
+    Arguments:
+        w, x, y, z: float, the transform's rotation as a unit quaternion
+        tx, ty, tz: float, the transform's translation, applied after the rotation
+        shape: float array of shape (3, 4), the top three rows of the row-major affine matrix to transform
+        out: float array of length 16, filled with the row-major product
+    """
+    # rotation matrix of the quaternion
+    r00 = 1 - 2 * (y * y + z * z)
+    r01 = 2 * (x * y - w * z)
+    r02 = 2 * (x * z + w * y)
+    r10 = 2 * (x * y + w * z)
+    r11 = 1 - 2 * (x * x + z * z)
+    r12 = 2 * (y * z - w * x)
+    r20 = 2 * (x * z - w * y)
+    r21 = 2 * (y * z + w * x)
+    r22 = 1 - 2 * (x * x + y * y)
+    # both bottom rows are (0, 0, 0, 1), so only the last column picks up the translation, and the product's bottom row is the same
+    for c in range(3):
+        s0 = shape[0, c]
+        s1 = shape[1, c]
+        s2 = shape[2, c]
+        out[c] = r00 * s0 + r01 * s1 + r02 * s2
+        out[4 + c] = r10 * s0 + r11 * s1 + r12 * s2
+        out[8 + c] = r20 * s0 + r21 * s1 + r22 * s2
+        out[12 + c] = 0
+    s0 = shape[0, 3]
+    s1 = shape[1, 3]
+    s2 = shape[2, 3]
+    out[3] = r00 * s0 + r01 * s1 + r02 * s2 + tx
+    out[7] = r10 * s0 + r11 * s1 + r12 * s2 + ty
+    out[11] = r20 * s0 + r21 * s1 + r22 * s2 + tz
+    out[15] = 1
+
+# how far a local transform component has to move for its joint to count as changed
+CHANGE_TOLERANCE = 1e-6
+
+@njit('void(int32[::1], float32[:, ::1], float32[:, ::1], float32[:, ::1], float32[:, :, ::1], float32[:, ::1], float32[:, ::1], float32[:, ::1], float32[:, ::1], float32[:, ::1], float32[:, ::1], boolean[::1])', cache=True, fastmath=True)
+def update_globals(parent_idx, joint_offsets, local_rotations, local_translations, shape_matrices, prev_local_rotations, prev_local_translations, global_rotations, global_translations, child_bases, object_matrices, changed):
+    """
+    Computes the global transforms of a joint hierarchy from the joints' local transforms,
+    and the final transforms of the joints' objects from those, all in one pass.
+    Joints are given in flat arrays, with each joint's parent coming before it.
+    Only joints that changed since they were last computed are recomputed, the rest keep their previous global transforms.
+    A joint changed if its local transform moved more than CHANGE_TOLERANCE, or its parent changed.
+
+    Arguments:
+        parent_idx: int32 array of length n, the index of each joint's parent, or -1 for the root
+        joint_offsets: float array of shape (n, 3), the offset from each joint's base to where its children start
+        local_rotations: float array of shape (n, 4), each joint's rotation relative to its parent as a (scalar, x, y, z) quaternion
+        local_translations: float array of shape (n, 3), each joint's translation relative to its parent, applied before the rotation
+        shape_matrices: float array of shape (n, 3, 4), the top three rows of the row-major affine transform forming the shape of each joint's object
+        prev_local_rotations: float array of shape (n, 4), each joint's local rotation as of when it was last computed, updated for changed joints
+        prev_local_translations: float array of shape (n, 3), each joint's local translation as of when it was last computed, updated for changed joints
+        global_rotations: float array of shape (n, 4), filled with each joint's rotation relative to the world
+        global_translations: float array of shape (n, 3), filled with each joint's position in the world
+        child_bases: float array of shape (n, 3), filled with the position in the world where each joint's children start
+        object_matrices: float array of shape (n, 16), filled with the row-major global transform of each joint's object
+        changed: bool array of length n, filled with whether each joint changed
+    """
+    for i in range(parent_idx.shape[0]):
+        p = parent_idx[i]
+
+        # checked during the traversal, since the parent's flag is already known by the time its children are reached
+        dirty = p >= 0 and changed[p]
+        if not dirty:
+            for k in range(4):
+                if abs(local_rotations[i, k] - prev_local_rotations[i, k]) > CHANGE_TOLERANCE:
+                    dirty = True
+            for k in range(3):
+                if abs(local_translations[i, k] - prev_local_translations[i, k]) > CHANGE_TOLERANCE:
+                    dirty = True
+        changed[i] = dirty
+        if not dirty:
+            # nothing above or at this joint moved, so its transforms from last time are still right
+            continue
+        prev_local_rotations[i] = local_rotations[i]
+        prev_local_translations[i] = local_translations[i]
+
+        if p < 0:
+            # root, just use local transform
+            global_rotations[i] = local_rotations[i]
+            global_translations[i] = local_translations[i]
+        else:
+            # first do local transform, then move to parent's joint position, then move by parent's global transform
+            pw = global_rotations[p, 0]
+            px = global_rotations[p, 1]
+            py = global_rotations[p, 2]
+            pz = global_rotations[p, 3]
+            lw = local_rotations[i, 0]
+            lx = local_rotations[i, 1]
+            ly = local_rotations[i, 2]
+            lz = local_rotations[i, 3]
+            # rotation is the parent's rotation times the local rotation
+            global_rotations[i, 0] = pw * lw - px * lx - py * ly - pz * lz
+            global_rotations[i, 1] = pw * lx + px * lw + py * lz - pz * ly
+            global_rotations[i, 2] = pw * ly - px * lz + py * lw + pz * lx
+            global_rotations[i, 3] = pw * lz + px * ly - py * lx + pz * lw
+
+            # position is where the parent's children start, moved by the local translation rotated by the parent's rotation
+            # the parent's part is shared between all its children, so it was computed once for the parent
+            tx = child_bases[p, 0]
+            ty = child_bases[p, 1]
+            tz = child_bases[p, 2]
+            vx = local_translations[i, 0]
+            vy = local_translations[i, 1]
+            vz = local_translations[i, 2]
+            # only the root is usually translated, so skip rotating a zero translation
+            if vx != 0 or vy != 0 or vz != 0:
+                vx, vy, vz = _rotate(pw, px, py, pz, vx, vy, vz)
+                tx += vx
+                ty += vy
+                tz += vz
+            global_translations[i, 0] = tx
+            global_translations[i, 1] = ty
+            global_translations[i, 2] = tz
+
+        # where this joint's children start, its position plus its offset rotated by its rotation
+        ox, oy, oz = _rotate(global_rotations[i, 0], global_rotations[i, 1], global_rotations[i, 2], global_rotations[i, 3],
+            joint_offsets[i, 0], joint_offsets[i, 1], joint_offsets[i, 2])
+        child_bases[i, 0] = global_translations[i, 0] + ox
+        child_bases[i, 1] = global_translations[i, 1] + oy
+        child_bases[i, 2] = global_translations[i, 2] + oz
+
+        # do shape transform first to get model shape, then do global transform
+        _transform_shape(global_rotations[i, 0], global_rotations[i, 1], global_rotations[i, 2], global_rotations[i, 3],
+            global_translations[i, 0], global_translations[i, 1], global_translations[i, 2],
+            shape_matrices[i], object_matrices[i])
+
+@njit('void(float64[:, ::1], float64[:, ::1])', cache=True)
+def path_rotations(segments, rotations):
+    """
+    Computes the rotations that orient path segments, the same as QQuaternion.fromDirection(QVector3D(0, 0, -1), segment) would.
+    With that fixed direction the rotation matrix's axes work out to simple expressions of the segment's x and y,
+    so the quaternion is found from them directly.
+
+    Arguments:
+        segments: float array of shape (n, 3), the vector along each segment
+        rotations: float array of shape (n, 4), filled with the rotation of each segment as a (scalar, x, y, z) quaternion
+    """
+    for i in range(segments.shape[0]):
+        dx = segments[i, 0]
+        dy = segments[i, 1]
+        rotations[i, 0] = 0
+        rotations[i, 3] = 0
+        # x-axis is the segment crossed with the direction, which is (-dy, dx, 0)
+        length_sq = dx * dx + dy * dy
+        if length_sq <= 1e-5:
+            # segment is along the direction, Qt falls back to the shortest arc from +z to -z, half a turn around -y
+            rotations[i, 1] = 0
+            rotations[i, 2] = -1
+            continue
+        inv_length = 1 / math.sqrt(length_sq)
+        xx = -dy * inv_length
+        xy = dx * inv_length
+        # axes are x = (xx, xy, 0), y = (xy, -xx, 0), z = (0, 0, -1), so the matrix's trace is always -1
+        # convert from the larger of the first two diagonal entries, like QQuaternion.fromRotationMatrix does
+        if xx >= 0:
+            s = math.sqrt(2 * xx + 2)
+            rotations[i, 1] = 0.5 * s
+            rotations[i, 2] = xy / s
+        else:
+            s = math.sqrt(2 - 2 * xx)
+            rotations[i, 1] = xy / s
+            rotations[i, 2] = 0.5 * s
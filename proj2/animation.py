@@ -2,14 +2,17 @@
 
 import os.path
 
-from PyQt5.QtCore import QTimer
+import numpy as np
+from PyQt5.QtCore import QByteArray, QElapsedTimer
 from PyQt5.QtGui import QVector3D, QQuaternion
 from PyQt5.Qt3DCore import QEntity, QTransform
-from PyQt5.Qt3DRender import QPointLight
-from PyQt5.Qt3DExtras import Qt3DWindow, QCuboidMesh, QSphereMesh, QConeMesh, QPlaneMesh, QCylinderMesh, QPhongMaterial
+from PyQt5.Qt3DRender import QPointLight, QAttribute, QBuffer, QGeometryRenderer
+from PyQt5.Qt3DExtras import Qt3DWindow, QCuboidMesh, QSphereMesh, QConeMesh, QPlaneMesh, QCylinderMesh, QConeGeometry, QPhongMaterial
+from PyQt5.Qt3DLogic import QFrameAction
 from PyQt5.QtQml import QQmlComponent, QQmlEngine
 
 from . import util
+from . import _kin
 
 
 class Animation(object):
@@ -23,7 +26,7 @@ class Animation(object):
 
         Arguments:
             title: str, the window title
-            frame_rate: float, the number of frames to display per second
+            frame_rate: float, the most frames updated per second, rendered frames falling in an already updated frame are skipped
             run_time: float, the number of seconds to run the animation
         """
         self.title = title
@@ -32,8 +35,12 @@ class Animation(object):
         assert run_time > 0
         self.run_time = run_time
 
+        # next frame number that needs an update
         self.frame = 0
-        self.prev_update_time = None
+        # length of a nominal frame in seconds
+        self._frame_time = 1 / frame_rate
+        # pretend the previous update was one nominal frame before the start, so the first frame's dt doesn't need a special case
+        self.prev_update_time = -self._frame_time
 
         # import OpenGL so Qt can use it for rendering
         from OpenGL import GL
@@ -46,6 +53,17 @@ class Animation(object):
 
         self.qml_engine = QQmlEngine(self.view)
 
+        # materials shared between objects of the same color, keyed by the color's RGBA value
+        self._material_cache = {}
+        # meshes shared between objects with the same mesh parameters, keyed by the kind of mesh and its parameters
+        self._mesh_cache = {}
+        # released path segment entities, reused before any new ones are created
+        self._path_pool = []
+        # the same entities as a set, so releasing an entity that's already released doesn't pool it twice
+        self._path_pooled = set()
+        # transform and material of every path segment entity ever created, keyed by the entity
+        self._path_segments = {}
+
     def load_qml(self, path, parent):
         """
         Helper method to load an object using Qt's QML system.
@@ -66,6 +84,43 @@ class Animation(object):
             exit()
         return obj
 
+    def _material(self, color):
+        """
+        Helper method to get a material of the given color.
+        Objects of the same color share one material.
+
+        Arguments:
+            color: QColor, the diffuse color of the material
+
+        Returns:
+            the QPhongMaterial for the color
+        """
+        key = color.rgba()
+        material = self._material_cache.get(key)
+        if material is None:
+            material = QPhongMaterial(self.scene)
+            material.setDiffuse(color)
+            self._material_cache[key] = material
+        return material
+
+    def _mesh(self, key, create):
+        """
+        Helper method to get a shared mesh.
+        Objects with the same mesh parameters share one mesh, only their transforms differ.
+
+        Arguments:
+            key: tuple, the kind of mesh followed by its parameters
+            create: function taking no arguments, creates the mesh when there isn't one for the key yet
+
+        Returns:
+            the mesh for the key
+        """
+        mesh = self._mesh_cache.get(key)
+        if mesh is None:
+            mesh = create()
+            self._mesh_cache[key] = mesh
+        return mesh
+
     def add_light(self, position, intensity=1.0, color=util.hsl(0, 0, 100)):
         """
         Helper method to add a simple point light to the scene.
@@ -94,17 +149,11 @@ class Animation(object):
             the QTransform of the cube
         """
         cube_entity = QEntity(self.scene)
-
-        cube_mesh = QCuboidMesh()
-        cube_entity.addComponent(cube_mesh)
+        cube_entity.addComponent(self._mesh(('cube',), lambda: QCuboidMesh(self.scene)))
 
         cube_transform = QTransform(self.scene)
         cube_entity.addComponent(cube_transform)
 
-        if not hasattr(self, 'rgb_cube_material'):
-            # load material definition from QML
-            # this was the easiest way I could find to create a custom shader in Qt3D...
-            self.rgb_cube_material = self.load_qml(os.path.join(os.path.dirname(__file__), 'RGBCubeMaterial.qml'), self.scene)
         cube_entity.addComponent(self.rgb_cube_material)
 
         return cube_transform
@@ -120,16 +169,12 @@ class Animation(object):
             the QTransform of the sphere
         """
         sphere_entity = QEntity(self.scene)
-
-        sphere_mesh = QSphereMesh()
-        sphere_entity.addComponent(sphere_mesh)
+        sphere_entity.addComponent(self._mesh(('sphere',), lambda: QSphereMesh(self.scene)))
 
         sphere_transform = QTransform(self.scene)
         sphere_entity.addComponent(sphere_transform)
 
-        sphere_material = QPhongMaterial(self.scene)
-        sphere_material.setDiffuse(color)
-        sphere_entity.addComponent(sphere_material)
+        sphere_entity.addComponent(self._material(color))
 
         return sphere_transform
 
@@ -144,16 +189,12 @@ class Animation(object):
             the QTransform of the cylinder
         """
         cylinder_entity = QEntity(self.scene)
-
-        cylinder_mesh = QCylinderMesh()
-        cylinder_entity.addComponent(cylinder_mesh)
+        cylinder_entity.addComponent(self._mesh(('cylinder',), lambda: QCylinderMesh(self.scene)))
 
         cylinder_transform = QTransform(self.scene)
         cylinder_entity.addComponent(cylinder_transform)
 
-        cylinder_material = QPhongMaterial(self.scene)
-        cylinder_material.setDiffuse(color)
-        cylinder_entity.addComponent(cylinder_material)
+        cylinder_entity.addComponent(self._material(color))
 
         return cylinder_transform
 
@@ -168,19 +209,81 @@ class Animation(object):
             the QTransform of the cone
         """
         cone_entity = QEntity(self.scene)
-
-        cone_mesh = QConeMesh()
-        cone_entity.addComponent(cone_mesh)
+        cone_entity.addComponent(self._mesh(('cone',), lambda: QConeMesh(self.scene)))
 
         cone_transform = QTransform(self.scene)
         cone_entity.addComponent(cone_transform)
 
-        cone_material = QPhongMaterial(self.scene)
-        cone_material.setDiffuse(color)
-        cone_entity.addComponent(cone_material)
+        cone_entity.addComponent(self._material(color))
 
         return cone_transform
 
+    def add_instanced_cones(self, colors):
+        """
+        Helper method to add many cones to the scene, drawn all together in a single instanced draw call.
+        Each cone's transform comes from a buffer instead of its own QTransform,
+        so all the cones are moved at once by setting the buffer's data.
+
+        Qt3D still culls the entity as a whole, using the bounding volume of a single unit cone under the entity's QTransform.
+        The shader ignores that transform, so it should be set to cover all the cones,
+        otherwise every cone disappears at once when the unit cone's bounds leave the view.
+
+        Arguments:
+            colors: list of QColor's, the color of each cone's material, one per cone
+
+        Returns:
+            a tuple of the QEntity drawing the cones,
+            the QTransform placing the cones' bounding volume, whose scale times a third should be a radius around its translation enclosing all the cones,
+            and the QBuffer of the cones' transforms, to be filled with a row-major 4x4 float32 matrix per cone
+        """
+        count = len(colors)
+        cones_entity = QEntity(self.scene)
+
+        # same geometry a QConeMesh uses, with per-instance attributes added on
+        cones_renderer = QGeometryRenderer(cones_entity)
+        cones_geometry = QConeGeometry(cones_renderer)
+        cones_renderer.setGeometry(cones_geometry)
+        cones_renderer.setInstanceCount(count)
+
+        # one row of 16 floats per cone, passed to the shader as four rows of the matrix
+        matrix_buffer = QBuffer(QBuffer.VertexBuffer, cones_geometry)
+        matrix_buffer.setData(QByteArray(np.tile(np.eye(4, dtype=np.float32).ravel(), count).tobytes()))
+        for row in range(4):
+            row_attribute = QAttribute(cones_geometry)
+            row_attribute.setName('instanceRow{}'.format(row))
+            row_attribute.setAttributeType(QAttribute.VertexAttribute)
+            row_attribute.setVertexBaseType(QAttribute.Float)
+            row_attribute.setVertexSize(4)
+            row_attribute.setByteOffset(row * 16)
+            row_attribute.setByteStride(64)
+            row_attribute.setCount(count)
+            row_attribute.setDivisor(1) # advance once per cone instead of once per vertex
+            row_attribute.setBuffer(matrix_buffer)
+            cones_geometry.addAttribute(row_attribute)
+
+        # colors never change, so they only get set once
+        color_buffer = QBuffer(QBuffer.VertexBuffer, cones_geometry)
+        color_buffer.setData(QByteArray(np.array([(color.redF(), color.greenF(), color.blueF()) for color in colors], dtype=np.float32).tobytes()))
+        color_attribute = QAttribute(cones_geometry)
+        color_attribute.setName('instanceColor')
+        color_attribute.setAttributeType(QAttribute.VertexAttribute)
+        color_attribute.setVertexBaseType(QAttribute.Float)
+        color_attribute.setVertexSize(3)
+        color_attribute.setByteStride(12)
+        color_attribute.setCount(count)
+        color_attribute.setDivisor(1)
+        color_attribute.setBuffer(color_buffer)
+        cones_geometry.addAttribute(color_attribute)
+
+        # only used for culling, see above
+        cones_transform = QTransform(self.scene)
+
+        cones_entity.addComponent(cones_renderer)
+        cones_entity.addComponent(cones_transform)
+        cones_entity.addComponent(self.cone_instance_material)
+
+        return cones_entity, cones_transform, matrix_buffer
+
     def add_plane(self, color=util.hsl(0, 0, 50)):
         """
         Helper method to add a plane to the scene.
@@ -192,16 +295,12 @@ class Animation(object):
             the QTransform of the plane
         """
         plane_entity = QEntity(self.scene)
-
-        plane_mesh = QPlaneMesh()
-        plane_entity.addComponent(plane_mesh)
+        plane_entity.addComponent(self._mesh(('plane',), lambda: QPlaneMesh(self.scene)))
 
         plane_transform = QTransform(self.scene)
         plane_entity.addComponent(plane_transform)
 
-        plane_material = QPhongMaterial(self.scene)
-        plane_material.setDiffuse(color)
-        plane_entity.addComponent(plane_material)
+        plane_entity.addComponent(self._material(color))
 
         return plane_transform
 
@@ -215,36 +314,72 @@ class Animation(object):
         Returns:
             a list of the entities added to the scene
         """
-        path_material = QPhongMaterial(self.scene)
-        path_material.setDiffuse(color)
+        path_material = self._material(color)
+        # all segments share one unit length mesh, their lengths go in their transforms' scale instead
+        radius = 0.05 # very thin
+        def create_path_mesh():
+            path_mesh = QCylinderMesh(self.scene)
+            path_mesh.setRadius(radius)
+            path_mesh.setLength(1)
+            return path_mesh
+        path_mesh = self._mesh(('path', radius), create_path_mesh)
+
+        # work out all the segments' geometry at once on the raw coordinates, so each segment doesn't create temporary vectors
+        coords = np.array([(pt.x(), pt.y(), pt.z()) for pt in pts], dtype=np.float64).reshape(-1, 3)
+        segments = coords[:-1] - coords[1:]
+        # only adjacent pairs of points that are different get a segment
+        keep = np.any(segments != 0, axis=1)
+        segments = segments[keep]
+        lengths = np.sqrt(np.einsum('ij,ij->i', segments, segments)) # length is the distance between the points
+        centers = ((coords[:-1] + coords[1:]) * 0.5)[keep] # center between points
+        rotations = np.empty((segments.shape[0], 4))
+        _kin.path_rotations(segments, rotations) # rotate to point along path
 
         # make a bunch of cylinder objects aligned along the path
         entities = []
-        prev_pt = None
-        for pt in pts:
-            if prev_pt is not None:
-                if prev_pt != pt:
-                    # for each adjacent pair of points that are different
-                    # make a cylinder
-                    path_entity = QEntity(self.scene)
-
-                    path_mesh = QCylinderMesh()
-                    path_mesh.setRadius(0.05) # very thin
-                    path_mesh.setLength((prev_pt - pt).length()) # length is the distance between the points
-                    path_entity.addComponent(path_mesh)
-
-                    path_transform = QTransform(self.scene)
-                    path_transform.setRotation(QQuaternion.fromDirection(QVector3D(0, 0, -1), prev_pt - pt)) # rotate to point along path
-                    path_transform.setTranslation((pt + prev_pt) / 2) # center between points
-                    path_entity.addComponent(path_transform)
-
+        for length, rotation, center in zip(lengths.tolist(), rotations.tolist(), centers.tolist()):
+            # make a cylinder, reusing a released one if there are any
+            if self._path_pool:
+                path_entity = self._path_pool.pop()
+                self._path_pooled.remove(path_entity)
+                path_transform, old_material = self._path_segments[path_entity]
+                if old_material is not path_material:
+                    path_entity.removeComponent(old_material)
                     path_entity.addComponent(path_material)
-
-                    entities.append(path_entity)
-            prev_pt = pt
+                    self._path_segments[path_entity] = (path_transform, path_material)
+                path_entity.setEnabled(True)
+            else:
+                path_entity = QEntity(self.scene)
+                path_entity.addComponent(path_mesh)
+                path_transform = QTransform(self.scene)
+                path_entity.addComponent(path_transform)
+                path_entity.addComponent(path_material)
+                self._path_segments[path_entity] = (path_transform, path_material)
+
+            # the cylinder's length is along its y-axis, stretch it to the distance between the points
+            path_transform.setScale3D(QVector3D(1, length, 1))
+            path_transform.setRotation(QQuaternion(*rotation))
+            path_transform.setTranslation(QVector3D(*center))
+
+            entities.append(path_entity)
 
         return entities
 
+    def release_path(self, entities):
+        """
+        Helper method to remove a path from the scene.
+        The path's entities get reused by later paths. Entities that are already released are skipped.
+
+        Arguments:
+            entities: list of QEntity's, the entities of a path returned by add_path
+        """
+        for path_entity in entities:
+            if path_entity in self._path_pooled:
+                continue
+            path_entity.setEnabled(False)
+            self._path_pool.append(path_entity)
+            self._path_pooled.add(path_entity)
+
     def setup_scene(self, background_color, camera_position, camera_lookat):
         """
         Sets up the scene. Should be called before running the animation.
@@ -258,6 +393,7 @@ class Animation(object):
         self.view.defaultFrameGraph().setClearColor(background_color)
 
         self.scene = QEntity()
+        self._init_shared_materials()
 
         # let subclass populate scene
         self.make_scene()
@@ -274,6 +410,17 @@ class Animation(object):
 
         self.view.setRootEntity(self.scene)
 
+    def _init_shared_materials(self):
+        """
+        Creates the materials that don't depend on any parameters, which every object using them shares.
+        Called once the scene exists, so the helpers adding objects don't need to check for them.
+        """
+        # load material definition from QML
+        # this was the easiest way I could find to create a custom shader in Qt3D...
+        self.rgb_cube_material = self.load_qml(os.path.join(os.path.dirname(__file__), 'RGBCubeMaterial.qml'), self.scene)
+        # instanced cones get their transforms and colors from per-instance attributes, which needs a custom shader too
+        self.cone_instance_material = self.load_qml(os.path.join(os.path.dirname(__file__), 'ConeInstanceMaterial.qml'), self.scene)
+
     def make_scene(self):
         """
         Abstract method. Populates the scene with objects.
@@ -282,23 +429,29 @@ class Animation(object):
 
     def _update(self):
         """
-        Updates the animation, rendering the next frame.
+        Updates the animation. Called once for every frame Qt3D renders.
         """
         # current animation time in seconds
-        t = util.lerp(self.frame, 0, self.frame_rate, 0, 1)
-        # change in time since the last frame
-        dt = 1 / self.frame_rate if self.prev_update_time is None else t - self.prev_update_time
-        # call subclass's frame update
-        self.update(self.frame, t, dt)
+        # frames come at whatever rate the renderer runs at, so the time is measured instead of counted in frames
+        t = self.clock.elapsed() * 0.001
+        # frame number is which nominal frame the time falls in, so frames the renderer didn't get to are dropped
+        frame = int(t * self.frame_rate)
+        # when the renderer runs faster than the frame rate, don't compute the same frame twice
+        if frame >= self.frame:
+            # change in time since the last update
+            dt = t - self.prev_update_time
+            # call subclass's frame update
+            self.update(frame, t, dt)
+
+            self.prev_update_time = t
+            # next frame that needs an update
+            self.frame = frame + 1
 
         # stop the animation and close the window if run past run_time
         if t >= self.run_time:
-            self.animation_timer.stop()
+            self.frame_action.triggered.disconnect()
             self.view.close()
 
-        self.prev_update_time = t
-        self.frame += 1
-
     def update(self, frame, t, dt):
         """
         Abstract method. Updates one frame of the animation.
@@ -314,12 +467,15 @@ class Animation(object):
         """
         Runs the animation asynchronously. The animation runs in the background for self.run_time seconds.
         """
-        self.animation_timer = QTimer(self.view)
-        # timer interval in msecs
-        self.animation_timer.setInterval(1000 / self.frame_rate)
-        # call update on each timeout of the timer
-        self.animation_timer.timeout.connect(self._update)
-        self.animation_timer.start()
+        # Qt3D triggers the frame action once per rendered frame
+        # updating from it keeps the animation in step with the renderer, so no updates are wasted when the renderer stalls
+        self.frame_action = QFrameAction(self.scene)
+        self.scene.addComponent(self.frame_action)
+        self.frame_action.triggered.connect(lambda render_dt: self._update())
+
+        # start the animation clock
+        self.clock = QElapsedTimer()
+        self.clock.start()
 
         # show the main window
         self.view.show()
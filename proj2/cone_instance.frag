@@ -0,0 +1,67 @@
+#version 330 core
+
+// fragment shader for instanced cone material
+// same Phong lighting as QPhongMaterial with its default ambient, specular and shininess, with the diffuse color from the instance
+
+const int MAX_LIGHTS = 8;
+const int TYPE_DIRECTIONAL = 1;
+
+struct Light {
+    int type;
+    vec3 position;
+    vec3 color;
+    float intensity;
+    vec3 direction;
+    float constantAttenuation;
+    float linearAttenuation;
+    float quadraticAttenuation;
+};
+
+// set by Qt3D from the lights in the scene
+uniform Light lights[MAX_LIGHTS];
+uniform int lightCount;
+uniform vec3 eyePosition;
+
+const vec3 ka = vec3(0.05, 0.05, 0.05);
+const vec3 ks = vec3(0.01, 0.01, 0.01);
+const float shininess = 150.0;
+
+in vec3 worldPosition;
+in vec3 worldNormal;
+in vec3 color;
+
+out vec4 fragColor;
+
+void main() {
+    vec3 n = normalize(worldNormal);
+    vec3 v = normalize(eyePosition - worldPosition);
+
+    vec3 diffuseColor = vec3(0.0);
+    vec3 specularColor = vec3(0.0);
+    for (int i = 0; i < lightCount; ++i) {
+        float att = 1.0;
+        vec3 s;
+        if (lights[i].type != TYPE_DIRECTIONAL) {
+            s = lights[i].position - worldPosition;
+            float dist = length(s);
+            float falloff = lights[i].constantAttenuation + lights[i].linearAttenuation * dist + lights[i].quadraticAttenuation * dist * dist;
+            if (falloff > 0.0)
+                att = 1.0 / falloff;
+        } else {
+            s = -lights[i].direction;
+        }
+        s = normalize(s);
+
+        float diffuse = max(dot(s, n), 0.0);
+        float specular = 0.0;
+        if (diffuse > 0.0) {
+            vec3 r = reflect(-s, n);
+            specular = (shininess + 2.0) / 2.0 * pow(max(dot(r, v), 0.0), shininess);
+        }
+
+        diffuseColor += att * lights[i].intensity * diffuse * lights[i].color;
+        specularColor += att * lights[i].intensity * specular * lights[i].color;
+    }
+
+    fragColor = vec4(ka + color * diffuseColor + ks * specularColor, 1.0);
+}
@@ -0,0 +1,34 @@
+#version 330 core
+
+// vertex shader for instanced cone material
+
+in vec3 vertexPosition;
+in vec3 vertexNormal;
+
+// per-instance attributes, the rows of the instance's row-major transform and its color
+in vec4 instanceRow0;
+in vec4 instanceRow1;
+in vec4 instanceRow2;
+in vec4 instanceRow3;
+in vec3 instanceColor;
+
+out vec3 worldPosition;
+out vec3 worldNormal;
+out vec3 color;
+
+uniform mat4 viewMatrix;
+uniform mat4 projectionMatrix;
+
+void main() {
+    // GLSL matrices are built from columns, so build from the rows and transpose
+    mat4 instanceMatrix = transpose(mat4(instanceRow0, instanceRow1, instanceRow2, instanceRow3));
+
+    // lighting is done in world space, the instance transform is the whole model transform
+    // the entity's own transform only places its bounding volume for culling, so it isn't applied
+    worldPosition = vec3(instanceMatrix * vec4(vertexPosition, 1.0));
+    // transforms have non-uniform scale, so normals need the inverse transpose
+    worldNormal = transpose(inverse(mat3(instanceMatrix))) * vertexNormal;
+    color = instanceColor;
+
+    gl_Position = projectionMatrix * viewMatrix * vec4(worldPosition, 1.0);
+}
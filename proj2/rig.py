@@ -1,94 +1,318 @@
 # -*- coding: utf-8 -*-
 
-from collections import defaultdict
-
-from PyQt5.QtGui import QMatrix4x4
+import numpy as np
+from PyQt5.QtCore import QByteArray
+from PyQt5.QtGui import QMatrix4x4, QQuaternion, QVector3D
 
 from . import util
+from . import _kin
+
+
+# rotation of a joint with no rotation, as a (scalar, x, y, z) quaternion
+_IDENTITY_ROTATION = np.array((1, 0, 0, 0), dtype=np.float32)
+# color of joints not given one, gray
+_DEFAULT_COLOR = util.hsl(0, 0, 50)
 
 
 class Rig(object):
     """
     Class representing a kinematic rig containing joints.
+
+    The transforms of all the joints are stored in flat arrays indexed by Joint.index.
+    Joints are indexed in the order they were added to the rig, so a joint's parent always comes before it.
+    The local transforms can be set through each joint, or by writing to local_rotations and local_translations directly.
     """
 
     class Joints(object):
         """
         Utility class that acts as a namespace allowing arbitrary attributes to be set on it.
-        When an attribute is referenced that doesn't exist,
-        it gets by default initialized to another instance of this class.
+        Nested namespaces are created explicitly with child, which returns the existing one if there is one.
         This allows easily defining nested attributes like so:
             j = Joints()
-            j.a.b.c = 'joint'
-        The attribute 'a' of j gets initialized to a new Joint() instance when it is referenced, and so on.
+            j.child('a').child('b').c = 'joint'
+        Referencing an attribute that doesn't exist raises AttributeError, so reading a misspelled name can't silently create a new namespace.
+        Joints can also be stored by integer key, for lists of joints.
+        Iterating goes over every entry, named or not, in the order they were first set.
+        Names starting with '_' are private, and names of the class's own methods like add and child can't be used.
         """
 
         def __init__(self):
-            # all attributes stored in defaultdict, which initializes missing keys to another instance of this class
-            self._joints = defaultdict(Rig.Joints)
+            # every entry by name or integer key, in the order they were first set
+            self._entries = {}
+            # key add stores the next joint under, one past the largest integer key used so far
+            self._next_index = 0
+
+        @staticmethod
+        def _is_name(name):
+            """
+            Checks if a key is the name of a named attribute.
+            Names starting with '_' are private attributes of the namespace itself, not part of it.
+
+            Arguments:
+                name: the key to check
+
+            Returns:
+                bool, whether the key is a name in the namespace
+            """
+            return isinstance(name, str) and not name.startswith('_')
+
+        def child(self, name):
+            """
+            Gets a nested namespace, creating it if it doesn't exist yet.
+
+            Arguments:
+                name: str or int, the name or key of the nested namespace
+
+            Returns:
+                Joints, the nested namespace
+            """
+            if name not in self:
+                self[name] = Rig.Joints()
+            return self[name]
 
         def __getitem__(self, index):
-            return self._joints[index]
+            if isinstance(index, int) or self._is_name(index):
+                return self._entries[index]
+            raise KeyError(index)
 
         def __setitem__(self, index, value):
-            self._joints[index] = value
+            if isinstance(index, int):
+                self._entries[index] = value
+                self._next_index = max(self._next_index, index + 1)
+            elif self._is_name(index):
+                setattr(self, index, value)
+            else:
+                raise KeyError(index)
 
         def __delitem__(self, index):
-            del self._joints[index]
+            if isinstance(index, int):
+                del self._entries[index]
+            elif self._is_name(index) and index in self._entries:
+                delattr(self, index)
+            else:
+                raise KeyError(index)
 
         def add(self, joint):
-            self._joints[len(self._joints)] = joint
+            """
+            Adds a joint under the next integer key, one past the largest one used so far.
+
+            Arguments:
+                joint: Joint, the joint to add
+            """
+            self[self._next_index] = joint
 
         def __len__(self):
-            return len(self._joints)
+            return len(self._entries)
 
         def __iter__(self):
-            return iter(self._joints.values())
+            return iter(self._entries.values())
 
         def __contains__(self, value):
-            return value in self._joints
-
-        def __getattr__(self, attr):
-            return self._joints[attr]
+            return (isinstance(value, int) or self._is_name(value)) and value in self._entries
 
         def __setattr__(self, attr, value):
+            # named attributes are real instance attributes too, so reading them is a plain attribute lookup
+            # but they can't replace the namespace's own methods and attributes
             if not attr.startswith('_'):
-                self._joints[attr] = value
-            else:
-                super().__setattr__(attr, value)
+                if hasattr(type(self), attr):
+                    raise AttributeError('{} is reserved and can\'t be used as a name in Joints'.format(attr))
+                self._entries[attr] = value
+            super().__setattr__(attr, value)
 
         def __delattr__(self, attr):
+            super().__delattr__(attr)
             if not attr.startswith('_'):
-                del self._joints[attr]
-            else:
-                super().__delattr__(attr)
+                del self._entries[attr]
 
-    def __init__(self, root):
+    def __init__(self, root, instanced=False):
         """
         Initializes the joints object with the required root joint.
+
+        Arguments:
+            root: Joint, the root joint of the rig
+            instanced: bool, whether to draw all the joints' cones in one instanced draw call, which needs OpenGL 3.3,
+                instead of each joint getting its own cone
         """
         self.joints = Rig.Joints()
         self.joints.root = root
 
+        # the animation the joints are drawn in
+        self._ani = root._ani
+        self._instanced = instanced
+        # the joints' cone transforms when each joint has its own cone, kept in a list so updating doesn't look them up on every joint every frame
+        self._object_transforms = []
+        # entity drawing all the joints' cones together, the transform placing its bounding volume, and the buffer of their transforms
+        # created on the first update, when the rig's joints are laid out
+        self._cones_entity = None
+        self._cones_transform = None
+        self._cones_buffer = None
+        # every joint in the rig, in index order
+        self._ordered = []
+        # local transforms, laid out along with the rest of the arrays once the joints are known
+        self._local_rotations = np.empty((0, 4), dtype=np.float32)
+        self._local_translations = np.empty((0, 3), dtype=np.float32)
+        # whether joints were added since the arrays were last laid out
+        self._stale = True
+        # add the root and any joints already created under it
+        # pre-order makes sure parents get added before their children
+        for joint in root.iter_hierarchy():
+            self._add(joint)
+
+    def _add(self, joint):
+        """
+        Adds a joint to the rig. Its parent must already be in the rig.
+
+        Arguments:
+            joint: Joint, the joint to add
+        """
+        joint.rig = self
+        joint.index = len(self._ordered)
+        self._ordered.append(joint)
+        # laid out on the next access instead of now, so adding many joints doesn't reallocate everything each time
+        self._stale = True
+
+    def _flatten(self):
+        """
+        Lays out the joint hierarchy in flat arrays.
+        Joints that were already laid out keep their local transforms, new joints start out with none.
+        """
+        n = len(self._ordered)
+        m = self._local_rotations.shape[0]
+        # all transforms are single precision, which is what Qt uses for them anyway
+        # index of each joint's parent, -1 for the root
+        self._parent_idx = np.array([-1 if joint.parent is None else joint.parent.index for joint in self._ordered], dtype=np.int32)
+        # offset from the base of each joint to where its children start
+        self._joint_offsets = np.zeros((n, 3), dtype=np.float32)
+        self._joint_offsets[:, 2] = [joint.length for joint in self._ordered]
+
+        # local transforms of each joint relative to its parent, rotations as (scalar, x, y, z) quaternions
+        # kept around so resetting is a single copy
+        self._identity_rotations = np.tile(_IDENTITY_ROTATION, (n, 1))
+        local_rotations = self._identity_rotations.copy()
+        local_rotations[:m] = self._local_rotations
+        local_translations = np.zeros((n, 3), dtype=np.float32)
+        local_translations[:m] = self._local_translations
+        self._local_rotations = local_rotations
+        self._local_translations = local_translations
+
+        # global transforms of each joint relative to the world
+        self._global_rotations = np.tile(_IDENTITY_ROTATION, (n, 1))
+        self._global_translations = np.zeros((n, 3), dtype=np.float32)
+        # position in the world where each joint's children start, shared by all of a joint's children
+        self._child_bases = np.zeros((n, 3), dtype=np.float32)
+
+        # transforms for forming the shape of each joint, and the final transforms of the joints' objects
+        # the shape transforms are affine, so only their top three rows are kept
+        # the object matrices are kept as rows of 16 floats, the same layout as the instanced cones' transform buffer
+        self._shape_matrices = np.array([joint._shape_matrix for joint in self._ordered], dtype=np.float32)
+        self._object_matrices = np.zeros((n, 16), dtype=np.float32)
+        if not self._instanced:
+            # give new joints their own cones
+            for joint in self._ordered[m:]:
+                joint._obj_transform = self._ani.add_cone(color=joint.color) # add cone, keep reference to its transform
+                self._object_transforms.append(joint._obj_transform)
+        elif self._cones_entity is not None and m != n:
+            # the cones were made for the old number of joints, so they get made again on the next update
+            # the arrays are only laid out again on the update after joints were added, so this happens once however many were added
+            self._cones_entity.deleteLater()
+            self._cones_entity = None
+            self._cones_transform = None
+            self._cones_buffer = None
+        # how far the cones stick out sideways from the joints' axes
+        self._max_thickness = max(joint.thickness for joint in self._ordered)
+
+        # local transforms as of the last time each joint was computed
+        # starting at the largest float makes every joint look changed on the first update
+        # it has to be finite, since the comparison runs in a fastmath kernel, which assumes there are no infinities
+        self._prev_local_rotations = np.full((n, 4), np.finfo(np.float32).max, dtype=np.float32)
+        self._prev_local_translations = np.full((n, 3), np.finfo(np.float32).max, dtype=np.float32)
+        # whether each joint changed in the last update
+        self._changed = np.zeros(n, dtype=np.bool_)
+
+        self._stale = False
+
+    @property
+    def local_rotations(self):
+        """
+        float32 array of shape (n, 4), the rotation of each joint relative to its parent as a (scalar, x, y, z) quaternion
+        """
+        if self._stale:
+            self._flatten()
+        return self._local_rotations
+
+    @property
+    def local_translations(self):
+        """
+        float32 array of shape (n, 3), the translation of each joint relative to the end of its parent, applied before the rotation
+        """
+        if self._stale:
+            self._flatten()
+        return self._local_translations
+
+    def iter_hierarchy(self):
+        """
+        Iterates every joint in the rig.
+
+        Returns:
+            an iterator of Joints, the rig's joints in index order, so each joint comes after its parent
+        """
+        return iter(self._ordered)
+
     def reset(self):
         """
         Resets the local transforms of the entire joint hieararchy.
         """
-        for joint in self.joints.root.iter_hierarchy():
-            joint.reset()
+        if self._stale:
+            self._flatten()
+        # every joint at once instead of through each joint
+        np.copyto(self._local_rotations, self._identity_rotations)
+        self._local_translations.fill(0)
 
     def update(self):
         """
         Updates the global transforms of the entire joint hieararchy.
         """
-        self.joints.root.update_transform()
+        if self._stale:
+            self._flatten()
+        # transform actual objects along with the joints, all in one pass over the hierarchy
+        # only joints that changed get recomputed
+        _kin.update_globals(self._parent_idx, self._joint_offsets,
+            self._local_rotations, self._local_translations, self._shape_matrices,
+            self._prev_local_rotations, self._prev_local_translations,
+            self._global_rotations, self._global_translations, self._child_bases, self._object_matrices,
+            self._changed)
+
+        if not self._instanced:
+            # only move cones of joints that actually changed, setting a matrix makes Qt3D propagate the change to the renderer
+            changed = self._changed
+            # convert the changed matrices to Python floats all at once, instead of unpacking each matrix element by element
+            rows = self._object_matrices[changed].tolist()
+            for i, row in zip(np.flatnonzero(changed), rows):
+                self._object_transforms[i].setMatrix(QMatrix4x4(*row))
+            return
+
+        # all the joints are drawn as one set of instanced cones
+        if self._cones_entity is None:
+            self._cones_entity, self._cones_transform, self._cones_buffer = self._ani.add_instanced_cones([joint.color for joint in self._ordered])
+            self._changed[:] = True
+        # move all the cones at once by uploading every transform in one buffer, but only if any joint actually changed,
+        # setting the data makes Qt3D send the buffer to the renderer
+        if self._changed.any():
+            self._cones_buffer.setData(QByteArray(self._object_matrices.tobytes()))
+            # Qt3D culls all the cones together, so their bounding volume has to cover every joint from its base to its end
+            points = np.concatenate((self._global_translations, self._child_bases))
+            low = points.min(axis=0)
+            high = points.max(axis=0)
+            self._cones_transform.setTranslation(QVector3D(*((low + high) * 0.5).tolist()))
+            # a unit cone always contains a ball around its center of radius a bit over 1/3, so scaling by 3 times the radius covers every point
+            self._cones_transform.setScale(3 * (float(np.linalg.norm(high - low)) * 0.5 + self._max_thickness))
 
 class Joint(object):
     """
     Class representing a single kinematic joint.
     """
 
-    def __init__(self, ani, length, thickness, parent=None, color=util.hsl(0, 0, 50)):
+    def __init__(self, ani, length, thickness, parent=None, color=None):
         """
         Creates a new joint.
 
@@ -97,58 +321,68 @@ class Joint(object):
             length: float, the length of the joint
             thickness: float, the thickness of the joint
             parent: Joint or None, the parent joint of this joint
-            color: QColor, the color of the joint's material
+            color: QColor or None, the color of the joint's material, gray if None
         """
+        if color is None:
+            color = _DEFAULT_COLOR
         self.parent = parent
         if self.parent is not None:
             # maintain parent's children list
-            self.parent.children.add(self)
-        self.children = set()
+            self.parent.children.append(self)
+        # kept in the order the children were added, so traversal order is deterministic
+        self.children = []
         self.length = length
         self.thickness = thickness
-        self._obj_transform = ani.add_cone(color=color) # add cone, keep reference to its transform
-
-        # transform for forming the shape of the joint
-        self._shape_transform = QMatrix4x4()
-        self._shape_transform.scale(thickness, thickness, length) # scale to joint's thickness and length
-        self._shape_transform.translate(0, 0, 0.5) # move forward so joint's origin is at its base
-        self._shape_transform.rotate(90, 1, 0, 0) # make sure cone points forward
+        self.color = color
+        # the joint is drawn as a cone by its rig, either on its own or along with the rest of the rig's joints
+        self._ani = ani
+        # transform of the joint's own cone, set by the rig when the joint isn't drawn instanced
+        self._obj_transform = None
+
+        # transform for forming the shape of the joint, as the top three rows of a row-major affine matrix
+        # scale to joint's thickness and length, after moving forward so joint's origin is at its base, after turning the cone to point forward
+        # written out directly instead of built up as a QMatrix4x4, since the rig only needs the numbers
+        self._shape_matrix = np.array((
+            (thickness, 0, 0, 0),
+            (0, 0, -thickness, 0),
+            (0, length, 0, 0.5 * length)), dtype=np.float32)
+
+        # the rig this joint belongs to and its index in the rig's transform arrays
+        # set when the joint is added to a rig
+        self.rig = None
+        self.index = None
+        if self.parent is not None and self.parent.rig is not None:
+            self.parent.rig._add(self)
+
+    @property
+    def local_rotation(self):
+        """
+        QQuaternion, the rotation of this joint relative to its parent
+        """
+        return QQuaternion(*self.rig.local_rotations[self.index])
 
-        # transform for making sure child joints start at the endpoint of this joint
-        self.joint_pos = QMatrix4x4()
-        self.joint_pos.translate(0, 0, length)
+    @local_rotation.setter
+    def local_rotation(self, rotation):
+        self.rig.local_rotations[self.index] = util.quat_components(rotation)
 
-        # local transform of this joint relative to its parent
-        self.local_transform = QMatrix4x4()
+    @property
+    def local_translation(self):
+        """
+        QVector3D, the translation of this joint relative to the end of its parent, applied before the rotation
+        """
+        return QVector3D(*self.rig.local_translations[self.index])
 
-        # global transform of this joint relative to the world
-        self._global_transform = QMatrix4x4()
+    @local_translation.setter
+    def local_translation(self, translation):
+        self.rig.local_translations[self.index] = (translation.x(), translation.y(), translation.z())
 
     def reset(self):
         """
         Resets the local transform of this joint.
         """
-        self.local_transform = QMatrix4x4()
-
-    def update_transform(self):
-        """
-        Updates this joint's global transform by using its local transform and its parent's global transform.
-        """
-        if self.parent is None:
-            # base case, just use local transform
-            self._global_transform = self.local_transform
-        else:
-            # has a parent
-            # first do local transform, then move to parent's joint position, then move by parent's global transform
-            self._global_transform = self.parent._global_transform * self.parent.joint_pos * self.local_transform
-
-        # transform actual object
-        # do shape transform first to get model shape, then do global transform
-        self._obj_transform.setMatrix(self._global_transform * self._shape_transform)
-
-        # update children recursively
-        for child in self.children:
-            child.update_transform()
+        # written in place into the rig's arrays, from a constant so nothing gets converted
+        self.rig.local_rotations[self.index] = _IDENTITY_ROTATION
+        self.rig.local_translations[self.index] = 0
 
     def iter_hierarchy(self):
         """
@@ -157,9 +391,11 @@ class Joint(object):
         Returns:
             an iterator of Joints, this joint's hierarchy in pre-order
         """
-        # this joint first
-        yield self
-        # then for each child
-        for child in self.children:
-            # yield that child's entire hierarchy
-            yield from child.iter_hierarchy()
+        # walk the hierarchy with an explicit stack instead of recursing, so deep chains don't stack up generator frames
+        stack = [self]
+        while stack:
+            joint = stack.pop()
+            # each joint comes before its children
+            yield joint
+            # children pushed in reverse so they come off the stack in their original order
+            stack.extend(reversed(joint.children))
@@ -16,3 +16,6 @@ def rad2deg(rad):
 
 def lerp(x, old_min, old_max, new_min, new_max):
     return (x - old_min) / (old_max - old_min) * (new_max - new_min) + new_min
+
+def quat_components(quaternion):
+    return (quaternion.scalar(), quaternion.x(), quaternion.y(), quaternion.z())